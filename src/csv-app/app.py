@@ -1,19 +1,35 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
 import os
 import data_processing
 import llm
+import manifest as missing_manifest
+import planner
 import utils
-import asyncio
 
-agent = llm.LLMAgent()
+
+@st.cache_resource
+def get_agent() -> llm.LLMAgent:
+    """
+    Returns the LLM agent shared by all sessions and reruns, so the
+    prompt is read and the HTTP client is created only once per process.
+    """
+    return llm.LLMAgent()
+
+
+agent = get_agent()
 
 if "started" not in st.session_state:
     st.session_state.started = True
 if "previous_file_name" not in st.session_state:
     st.session_state.previous_file_name = None
-if "llm_suggestions" not in st.session_state:
-    st.session_state.llm_suggestions = None
+# Suggestions per table, keyed by (rowid, column) so they survive undo,
+# redo and saves, which change the positions of the erroneous rows
+if "suggestion_cache" not in st.session_state:
+    st.session_state.suggestion_cache = {}
+if "tokens_used" not in st.session_state:
+    st.session_state.tokens_used = 0
 if "current_table" not in st.session_state:
     st.session_state.current_table = None
 if "data_corrected" not in st.session_state:
@@ -32,7 +48,9 @@ conn = data_processing.get_connection()
 if uploaded_file is not None:
     current_file_name = uploaded_file.name
     if current_file_name != st.session_state.previous_file_name:
-        data_processing.create_table(uploaded_file)
+        table_name = data_processing.create_table(uploaded_file)
+        st.session_state.suggestion_cache.pop(table_name, None)
+        st.session_state.current_table = None
         st.session_state.previous_file_name = current_file_name
         st.success(f"File '{current_file_name}' successfully processed!")
 
@@ -44,23 +62,102 @@ select_table = st.selectbox(
 if select_table is None:
     st.warning("No tables found in the database. Please upload a CSV file!")
 else:
+    query = f"SELECT * FROM {select_table}"
+    conn = data_processing.get_connection()
+    df_original = pd.read_sql_query(query, conn)
+    df_error = data_processing.return_erroneous_data(select_table)
+    manifest = missing_manifest.build_manifest(df_error)
+    suggestion_cache = st.session_state.suggestion_cache.setdefault(
+        select_table, {}
+    )
+
+    # Only missing values without a cached suggestion are sent to the LLM,
+    # so reruns after saving, undoing or redoing cost no requests
+    manifest_uncached = manifest[:0]
     if select_table != st.session_state.current_table:
         st.session_state.current_table = select_table
-        query = f"SELECT * FROM {select_table}"
-        conn = data_processing.get_connection()
-        df_original = pd.read_sql_query(query, conn)
-        df_error = data_processing.return_erroneous_data(select_table)
-
-        suggestions = asyncio.run(agent.send_missing_values_to_llm(
-            df_original=df_original,
-            df_error=df_error
-        ))
-        st.session_state.llm_suggestions = agent.gather_respones(suggestions)
-    else:
-        query = f"SELECT * FROM {select_table}"
-        conn = data_processing.get_connection()
-        df_original = pd.read_sql_query(query, conn)
-        df_error = data_processing.return_erroneous_data(select_table)
+        uncached = np.array([
+            (rowid, col) not in suggestion_cache
+            for _, rowid, col in missing_manifest.iter_cells(
+                manifest, df_error.columns
+            )
+        ], dtype=bool)
+        manifest_uncached = manifest[uncached]
+
+    if len(manifest_uncached):
+        token_budget = os.getenv("TOKEN_BUDGET")
+        if token_budget is not None:
+            token_budget = max(
+                0, int(token_budget) - st.session_state.tokens_used
+            )
+        plan = planner.plan_imputation(
+            agent,
+            df_original,
+            df_error,
+            token_budget=token_budget,
+            manifest=manifest_uncached,
+        )
+        st.info(
+            f"{plan['missing_cells']} missing values: "
+            f"{plan['requests']} requests, about "
+            f"{plan['prompt_tokens'] + plan['completion_tokens']} tokens "
+            f"and {plan['seconds']:.0f} s."
+        )
+        if plan["local_cells"]:
+            st.warning(
+                f"The token budget only covers {len(plan['llm_cells'])} "
+                f"missing values, {len(plan['local_cells'])} are imputed "
+                "with the median or most frequent value of their column."
+            )
+
+        # The agent is shared by all sessions, so the usage of this
+        # session is tracked per run
+        usage = agent.new_usage()
+        llm_suggestions = {}
+        failures = []
+        if plan["llm_cells"]:
+            suggestions = agent.run(agent.send_missing_values_to_llm(
+                df_original=df_original,
+                df_error=df_error,
+                cells=plan["llm_cells"],
+                manifest=manifest_uncached,
+                usage=usage,
+                token_budget=token_budget
+            ))
+            llm_suggestions = agent.gather_respones(
+                suggestions, failures=failures
+            )
+        if failures:
+            st.warning(
+                f"No suggestion could be retrieved for {len(failures)} "
+                "missing values, they are imputed with the median or most "
+                "frequent value of their column."
+            )
+        st.session_state.tokens_used += (
+            usage["prompt_tokens"] + usage["completion_tokens"]
+        )
+        local_suggestions = planner.impute_locally(
+            df_original, plan["local_cells"] + failures
+        )
+        for suggestions, source in (
+            (local_suggestions, "local"), (llm_suggestions, "llm")
+        ):
+            for index, values in suggestions.items():
+                rowid = int(df_error.index[index])
+                for col, value in values.items():
+                    suggestion_cache[(rowid, col)] = (value, source)
+
+    # Positional suggestions of the current erroneous rows
+    llm_suggestions = {}
+    local_suggestions = {}
+    for index, rowid, col in missing_manifest.iter_cells(
+        manifest, df_error.columns
+    ):
+        if (rowid, col) in suggestion_cache:
+            value, source = suggestion_cache[(rowid, col)]
+            llm_suggestions.setdefault(index, {})[col] = value
+            if source == "local":
+                local_suggestions.setdefault(index, {})[col] = value
 
     st.write(f"**Selected table**: {select_table}")
     st.write(df_original)
@@ -68,11 +165,14 @@ else:
     st.write(df_error)
 
     corrections_list = []
-    for index, row in df_error.iterrows():
+    for index, _, columns_nan in missing_manifest.iter_rows(
+        manifest, df_error.columns
+    ):
         corrected_values = utils.display_error(
             df=df_error,
             index=index,
-            llm_suggestions=st.session_state.llm_suggestions
+            llm_suggestions=llm_suggestions,
+            columns_nan=columns_nan
         )
         corrections_list.append(corrected_values)
 
@@ -86,10 +186,25 @@ else:
             corrections_dict,
             df_error,
             select_table,
+            llm_suggestions=llm_suggestions,
+            local_suggestions=local_suggestions,
+            manifest=manifest,
         )
         st.session_state.current_table = None
         st.session_state.data_corrected = True
 
+    undo_column, redo_column = st.columns(2)
+    if undo_column.button("Undo last save"):
+        if data_processing.undo_corrections(select_table):
+            st.rerun()
+        else:
+            st.info("Nothing to undo.")
+    if redo_column.button("Redo"):
+        if data_processing.redo_corrections(select_table):
+            st.rerun()
+        else:
+            st.info("Nothing to redo.")
+
     if st.session_state.data_corrected:
         corrected_data = utils.convert_df(select_table)
         st.write("Data corrected and saved!")
@@ -100,3 +215,9 @@ else:
             file_name=f"{select_table}_corrected.csv",
             mime="text/csv"
         )
+        st.download_button(
+            label="Download changes only",
+            data=data_processing.export_changes(select_table),
+            file_name=f"{select_table}_changes.csv",
+            mime="text/csv"
+        )
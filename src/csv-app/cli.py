@@ -0,0 +1,366 @@
+import argparse
+import os
+import time
+import uuid
+import data_processing
+import llm
+import manifest as missing_manifest
+import planner
+import profiler
+
+
+def parse_args(argv: list[str] = None) -> argparse.Namespace:
+    """
+    Parses the command line arguments of the batch imputation CLI.
+
+    Parameters
+    ----------
+    argv: list[str]
+        The arguments to parse, defaults to sys.argv
+
+    Returns
+    -------
+    argparse.Namespace
+        The parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Fill the missing values of a CSV file with LLM suggestions "
+            "without the Streamlit UI. All suggestions are accepted."
+        )
+    )
+    parser.add_argument("input", help="Path of the CSV file to correct")
+    parser.add_argument("output", help="Path of the corrected CSV file")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=None,
+        help="Maximum number of requests in flight (default: MAX_CONCURRENCY)"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=500,
+        help="Number of erroneous rows sent and saved per batch"
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=10000,
+        help="Number of rows read from and written to the CSV files at once"
+    )
+    parser.add_argument(
+        "--backend",
+        default=None,
+        help="Base URL of an OpenAI compatible API (default: OpenAI)"
+    )
+    parser.add_argument(
+        "--model",
+        default=None,
+        help="Name of the model (default: MODEL_NAME)"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=None,
+        help=(
+            "Stream the answers and stop reading once the value is "
+            "complete (default: STREAM)"
+        )
+    )
+    parser.add_argument(
+        "--input-price",
+        type=float,
+        default=0.15,
+        help="Price in USD per million prompt tokens"
+    )
+    parser.add_argument(
+        "--output-price",
+        type=float,
+        default=0.60,
+        help="Price in USD per million completion tokens"
+    )
+    parser.add_argument(
+        "--token-budget",
+        type=int,
+        default=None,
+        help=(
+            "Maximum number of tokens to spend on the file, missing values "
+            "beyond the budget are imputed locally"
+        )
+    )
+    parser.add_argument(
+        "--seconds-per-request",
+        type=float,
+        default=2.0,
+        help="Expected latency of one request, used to project the duration"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only print the plan without sending any request"
+    )
+    parser.add_argument(
+        "--database",
+        default=None,
+        help=(
+            "Path of the SQLite database holding the working table "
+            "(default: DATBASE)"
+        )
+    )
+    parser.add_argument(
+        "--keep-table",
+        action="store_true",
+        help="Keep the working table in the SQLite database after exporting it"
+    )
+    return parser.parse_args(argv)
+
+
+def impute_file(args: argparse.Namespace, agent: llm.LLMAgent) -> dict:
+    """
+    Loads a CSV file into the database, fills its missing values with the
+    suggestions of the LLM and writes the corrected table to a CSV file.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        The parsed command line arguments
+    agent: llm.LLMAgent
+        The agent used to request the suggestions
+
+    Returns
+    -------
+    dict
+        The number of rows, erroneous rows, corrected cells, cells whose
+        request failed and cells skipped because of the token budget
+    """
+    # A unique working table, so the tables of the app and of parallel
+    # runs on files with the same name are never touched
+    table_name = f"cli_{uuid.uuid4().hex}"
+    profile = profiler.TableProfile()
+    with open(args.input, "rb") as csv_file:
+        table_name = data_processing.create_table(
+            csv_file,
+            table_name=table_name,
+            chunksize=args.chunksize,
+            profile=profile,
+        )
+
+    df_error = data_processing.return_erroneous_data(table_name)
+    manifest = missing_manifest.build_manifest(df_error)
+
+    plan = planner.plan_imputation(
+        agent,
+        None,
+        df_error,
+        token_budget=args.token_budget,
+        seconds_per_request=args.seconds_per_request,
+        manifest=manifest,
+        profile=profile,
+    )
+    print_plan(plan, args)
+    if args.dry_run:
+        return {
+            "rows": profile.rows,
+            "erroneous_rows": len(df_error),
+            "cells": 0,
+            "failed_cells": 0,
+            "skipped_cells": 0,
+        }
+
+    # Group the planned cells by batch once instead of scanning them
+    # for every batch
+    batch_cells = {}
+    for source in ("llm_cells", "local_cells"):
+        for index, col in plan[source]:
+            start = index - index % args.batch_size
+            batch_cells.setdefault((source, start), []).append(
+                (index - start, col)
+            )
+
+    cells = 0
+    failed_cells = 0
+    # Shared by all batches, so the budget holds for the whole file
+    usage = agent.new_usage()
+    for start in range(0, len(df_error), args.batch_size):
+        end = start + args.batch_size
+        df_batch = df_error.iloc[start:end]
+        batch_manifest = missing_manifest.slice_manifest(manifest, start, end)
+        llm_cells = batch_cells.get(("llm_cells", start), [])
+        local_cells = batch_cells.get(("local_cells", start), [])
+        llm_suggestions = {}
+        failures = []
+        if llm_cells:
+            suggestions = agent.run(agent.send_missing_values_to_llm(
+                df_original=None,
+                df_error=df_batch,
+                cells=llm_cells,
+                manifest=batch_manifest,
+                profile=profile,
+                usage=usage,
+                token_budget=args.token_budget
+            ))
+            llm_suggestions = agent.gather_respones(
+                suggestions, failures=failures
+            )
+        # Cells without a usable answer are imputed locally instead
+        failed_cells += len(failures)
+        local_cells += failures
+        local_suggestions = planner.impute_locally(
+            None, local_cells, profile=profile
+        )
+        corrections_dict = {
+            index: {
+                **local_suggestions.get(index, {}),
+                **llm_suggestions.get(index, {}),
+            }
+            for index in llm_suggestions.keys() | local_suggestions.keys()
+        }
+        data_processing.save_corrections(
+            corrections_dict,
+            df_batch,
+            table_name,
+            llm_suggestions=llm_suggestions,
+            local_suggestions=local_suggestions,
+            manifest=batch_manifest,
+        )
+        cells += sum(len(value) for value in corrections_dict.values())
+        print(
+            f"{min(start + args.batch_size, len(df_error))}/{len(df_error)} "
+            "erroneous rows processed"
+        )
+
+    data_processing.export_table(
+        table_name, args.output, chunksize=args.chunksize
+    )
+    if args.keep_table:
+        print(f"Working table:     {table_name}")
+    else:
+        conn = data_processing.get_connection()
+        conn.execute(f"DROP TABLE IF EXISTS {table_name}")
+        conn.execute(
+            f"DELETE FROM {data_processing.CORRECTION_LOG} "
+            "WHERE table_name = ?",
+            (table_name,)
+        )
+        conn.commit()
+        conn.close()
+
+    return {
+        "rows": profile.rows,
+        "erroneous_rows": len(df_error),
+        "cells": cells,
+        # Skipped requests have no response and are counted as failures
+        "failed_cells": failed_cells - usage["skipped"],
+        "skipped_cells": usage["skipped"],
+    }
+
+
+def print_plan(plan: dict, args: argparse.Namespace) -> None:
+    """
+    Prints the estimated requests, tokens, cost and duration of a run.
+
+    Parameters
+    ----------
+    plan: dict
+        The plan returned by planner.plan_imputation
+    args: argparse.Namespace
+        The parsed command line arguments
+
+    Returns
+    -------
+    None
+    """
+    cost = (
+        plan["prompt_tokens"] * args.input_price
+        + plan["completion_tokens"] * args.output_price
+    ) / 1_000_000
+    print(f"Missing cells:     {plan['missing_cells']}")
+    print(f"LLM cells:         {len(plan['llm_cells'])}")
+    print(f"Local cells:       {len(plan['local_cells'])}")
+    print(f"Est. requests:     {plan['requests']}")
+    print(f"Est. prompt tok.:  {plan['prompt_tokens']}")
+    print(f"Est. compl. tok.:  {plan['completion_tokens']}")
+    print(f"Est. cost:         ${cost:.4f}")
+    print(f"Est. duration:     {plan['seconds']:.0f} s")
+
+
+def print_stats(
+    stats: dict, usage: dict, elapsed: float, args: argparse.Namespace
+) -> None:
+    """
+    Prints the throughput and cost of a run.
+
+    Parameters
+    ----------
+    stats: dict
+        The statistics returned by impute_file
+    usage: dict
+        The token usage of the agent
+    elapsed: float
+        The duration of the run in seconds
+    args: argparse.Namespace
+        The parsed command line arguments
+
+    Returns
+    -------
+    None
+    """
+    cost = (
+        usage["prompt_tokens"] * args.input_price
+        + usage["completion_tokens"] * args.output_price
+    ) / 1_000_000
+    print(f"Rows:              {stats['rows']}")
+    print(f"Erroneous rows:    {stats['erroneous_rows']}")
+    print(f"Corrected cells:   {stats['cells']}")
+    print(f"Failed cells:      {stats['failed_cells']} (imputed locally)")
+    if stats["skipped_cells"]:
+        print(f"Over budget:       {stats['skipped_cells']} (imputed locally)")
+    print(f"Requests:          {usage['requests']}")
+    print(f"Prompt tokens:     {usage['prompt_tokens']}")
+    print(f"Completion tokens: {usage['completion_tokens']}")
+    print(f"Elapsed:           {elapsed:.2f} s")
+    print(f"Throughput:        {stats['cells'] / max(elapsed, 1e-9):.2f} cells/s")
+    print(f"Estimated cost:    ${cost:.4f}")
+    if usage["streamed_requests"]:
+        streamed = usage["streamed_requests"]
+        seconds_to_value = usage["seconds_to_value"] / streamed
+        seconds_saved = usage["seconds_saved"] / streamed
+        # The full answer is estimated as the time to the value plus the
+        # time the skipped tokens would have taken at the measured rate
+        seconds_to_answer = seconds_to_value + seconds_saved
+        print(
+            "Time to value:     "
+            f"{seconds_to_value:.2f} s/cell "
+            f"(full answer est. {seconds_to_answer:.2f} s/cell)"
+        )
+        print(
+            "Time saved:        "
+            f"{seconds_saved:.2f} s/cell "
+            f"({seconds_saved / max(seconds_to_answer, 1e-9):.0%})"
+        )
+        print(
+            "Tokens saved:      "
+            f"{usage['completion_tokens_saved'] / streamed:.1f} tokens/cell"
+        )
+
+
+def main(argv: list[str] = None) -> None:
+    args = parse_args(argv)
+    if args.database is not None:
+        # get_connection reads the path from the environment
+        os.environ["DATBASE"] = args.database
+    agent = llm.LLMAgent(
+        model_name=args.model,
+        base_url=args.backend,
+        max_concurrency=args.concurrency,
+        stream=args.stream,
+    )
+    start = time.perf_counter()
+    stats = impute_file(args, agent)
+    elapsed = time.perf_counter() - start
+    print_stats(stats, agent.usage, elapsed, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,15 @@
 import sqlite3
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 import os
 import utils
+import manifest as missing_manifest
+import profiler
 from io import BytesIO
 
+CORRECTION_LOG = "correction_log"
+
 
 def get_connection() -> sqlite3.Connection:
     """
@@ -25,7 +30,12 @@ def get_connection() -> sqlite3.Connection:
     return conn
 
 
-def create_table(uploaded_csv: BytesIO) -> None:
+def create_table(
+    uploaded_csv: BytesIO,
+    table_name: str = None,
+    chunksize: int = None,
+    profile: profiler.TableProfile = None,
+) -> str:
     """
     Takes a CSV file and creates a table in the SQLite database
     with the same name as the file.
@@ -34,17 +44,28 @@ def create_table(uploaded_csv: BytesIO) -> None:
     ----------
     uploaded_csv: BytesIO
         The uploaded CSV file
+    table_name: str
+        The name of the table, defaults to the name of the file
+    chunksize: int
+        If given, the CSV file is read and inserted in chunks of
+        this many rows instead of loading it into memory at once
+    profile: profiler.TableProfile
+        If given, every chunk is also added to this profile, so the
+        statistics of the table are known without reading it again
 
     Returns
     -------
-    None
+    str
+        The name of the created table
     """
-    file_name = utils.remove_invalid_characters(uploaded_csv.name.split(".")[0])
-    df = pd.read_csv(uploaded_csv)
-    df.columns = df.columns.str.replace(' ', '_')
-    df.columns = [
-        utils.remove_invalid_characters(col) for col in df.columns
-    ]
+    if table_name is None:
+        table_name = uploaded_csv.name.split(".")[0]
+    file_name = utils.remove_invalid_characters(table_name)
+    if chunksize is None:
+        chunks = iter([pd.read_csv(uploaded_csv)])
+    else:
+        chunks = pd.read_csv(uploaded_csv, chunksize=chunksize)
+    df = _clean_columns(next(chunks))
     conn = get_connection()
     cursor = conn.cursor()
 
@@ -52,12 +73,46 @@ def create_table(uploaded_csv: BytesIO) -> None:
         f"{col} {utils.map_dtype_to_sql(df[col].dtype)}" for col in df.columns
     ]
     cursor.execute(f"DROP TABLE IF EXISTS {file_name}")
+    create_log_table(cursor)
+    cursor.execute(
+        f"DELETE FROM {CORRECTION_LOG} WHERE table_name = ?", (file_name,)
+    )
     print(f"CREATE TABLE {file_name} ({(", ").join(columns)})")
     cursor.execute(f"CREATE TABLE {file_name} ({(", ").join(columns)})")
+    conn.commit()
     fill_table(table_name=file_name, df=df)
+    if profile is not None:
+        profile.update(df)
+    for chunk in chunks:
+        chunk = _clean_columns(chunk)
+        fill_table(table_name=file_name, df=chunk)
+        if profile is not None:
+            profile.update(chunk)
 
     conn.commit()
     conn.close()
+    return file_name
+
+
+def _clean_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Replaces spaces and invalid characters in the column names.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        The DataFrame read from the CSV file
+
+    Returns
+    -------
+    df: pd.DataFrame
+        The DataFrame with valid column names
+    """
+    df.columns = df.columns.str.replace(' ', '_')
+    df.columns = [
+        utils.remove_invalid_characters(col) for col in df.columns
+    ]
+    return df
 
 
 def fill_table(table_name: str, df: pd.DataFrame) -> None:
@@ -82,7 +137,8 @@ def fill_table(table_name: str, df: pd.DataFrame) -> None:
 
 def return_erroneous_data(table_name: str) -> pd.DataFrame:
     """
-    Returns the rows where at least one value is missing.
+    Returns the rows where at least one value is missing. The index
+    of the DataFrame holds the SQLite rowid of each row.
 
     Parameters
     ----------
@@ -98,46 +154,64 @@ def return_erroneous_data(table_name: str) -> pd.DataFrame:
     where_clause = " OR ".join(
         [f"{col} IS NULL" for col in utils.get_all_columns(table_name)]
     )
-    query = f"SELECT * FROM {table_name} uploaded_file WHERE 1=1 AND {where_clause}"
-    df = pd.read_sql(query, conn)
+    query = (
+        f"SELECT rowid, * FROM {table_name} uploaded_file "
+        f"WHERE 1=1 AND {where_clause}"
+    )
+    df = pd.read_sql(query, conn, index_col="rowid")
     conn.close()
     return df
 
 
-def map_dtype_to_where(
-    dtype: pd.api.types.CategoricalDtype, col: str, value: str
-) -> str:
+def create_log_table(cursor: sqlite3.Cursor) -> None:
     """
-    Maps the dtype to a SQL WHERE clause. Adds single quotes
-    around the value if it is not a number or bool.
+    Creates the table logging every correction if it does not exist.
+    The value columns have no declared type so SQLite stores the old and
+    new values with their original type.
 
     Parameters
     ----------
-    dtype: pd.api.types.CategoricalDtype
-        The dtype of the column
-    col: str
-        The name of the column
-    value: str
-        The value to map
+    cursor: sqlite3.Cursor
+        The cursor used to create the table
 
     Returns
     -------
-    str
-        The mapped value
+    None
     """
-    if (
-        pd.api.types.is_float_dtype(dtype)
-        or pd.api.types.is_integer_dtype(dtype)
-        or pd.api.types.is_bool_dtype(dtype)
-    ):
-        return f"{col}={value}"
-    else:
-        return f"{col}='{value}'"
+    cursor.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {CORRECTION_LOG} (
+            id INTEGER PRIMARY KEY,
+            batch_id INTEGER NOT NULL,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            column_name TEXT NOT NULL,
+            old_value,
+            new_value,
+            source TEXT NOT NULL,
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            undone INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    cursor.execute(
+        f"CREATE INDEX IF NOT EXISTS {CORRECTION_LOG}_batch "
+        f"ON {CORRECTION_LOG} (table_name, batch_id)"
+    )
 
 
-def save_corrections(corrections_dict, df, table_name) -> None:
+def save_corrections(
+    corrections_dict,
+    df,
+    table_name,
+    llm_suggestions: dict = None,
+    local_suggestions: dict = None,
+    manifest: np.ndarray = None,
+) -> None:
     """
-    Saves the corrections to the SQLite database.
+    Saves the corrections to the SQLite database and logs every changed
+    cell in the same transaction. All corrections of one call form a
+    batch which can be undone and redone as a whole.
 
     Parameters
     ----------
@@ -147,31 +221,238 @@ def save_corrections(corrections_dict, df, table_name) -> None:
         The DataFrame with the erroneous rows
     table_name: str
         The name of the table
+    llm_suggestions: dict
+        The suggestions of the LLM, used to tell apart accepted
+        suggestions from values entered by the user
+    local_suggestions: dict
+        The values imputed without the LLM, logged with source "local"
+    manifest: np.ndarray
+        The missing value manifest of df, built if not given
 
     Returns
     -------
     None
     """
+    if llm_suggestions is None:
+        llm_suggestions = {}
+    if local_suggestions is None:
+        local_suggestions = {}
     conn = get_connection()
     cursor = conn.cursor()
+    create_log_table(cursor)
 
-    for key, value in corrections_dict.items():
-        temp = df.iloc[[key]]
-        columns = [col for col in temp.columns if not pd.isnull(temp[col].values[0])]
-        where_clause = " AND ".join(
-            [
-                f"{map_dtype_to_where(df[col].dtype, col, temp[col].values[0])}"
-                for col in columns
-            ]
+    # A new save invalidates everything that could have been redone
+    cursor.execute(
+        f"DELETE FROM {CORRECTION_LOG} WHERE table_name = ? AND undone = 1",
+        (table_name,)
+    )
+    cursor.execute(
+        f"SELECT COALESCE(MAX(batch_id), 0) + 1 FROM {CORRECTION_LOG}"
+    )
+    batch_id = cursor.fetchone()[0]
+
+    if manifest is None:
+        manifest = missing_manifest.build_manifest(df)
+    # Cells of the manifest were NULL, so their old value is known
+    updates = []
+    for key, row_id, key_corr in missing_manifest.iter_cells(
+        manifest, df.columns
+    ):
+        if key_corr in corrections_dict.get(key, {}):
+            updates.append((key, row_id, key_corr, None))
+    if len(updates) < sum(len(value) for value in corrections_dict.values()):
+        in_manifest = {(key, key_corr) for key, _, key_corr, _ in updates}
+        for key, value in corrections_dict.items():
+            for key_corr in value:
+                if (key, key_corr) in in_manifest:
+                    continue
+                row_id = int(df.index[key])
+                cursor.execute(
+                    f"SELECT {key_corr} FROM {table_name} WHERE rowid = ?",
+                    (row_id,)
+                )
+                updates.append(
+                    (key, row_id, key_corr, cursor.fetchone()[0])
+                )
+
+    updates_by_column = {}
+    log_entries = []
+    for key, row_id, key_corr, old_value in updates:
+        val_corr = corrections_dict[key][key_corr]
+        updates_by_column.setdefault(key_corr, []).append((val_corr, row_id))
+        if local_suggestions.get(key, {}).get(key_corr) == val_corr:
+            source = "local"
+        elif llm_suggestions.get(key, {}).get(key_corr) == val_corr:
+            source = "llm"
+        else:
+            source = "user"
+        log_entries.append(
+            (batch_id, table_name, row_id, key_corr,
+             old_value, val_corr, source)
         )
-        update_queries = []
-        for key_corr, val_corr in value.items():
-            set_value = map_dtype_to_where(df[key_corr].dtype, key_corr, val_corr)
-            update_queries.append(
-                f"UPDATE {table_name} SET {set_value} WHERE {where_clause}"
-            )
-        for query in update_queries:
-            cursor.execute(query)
+    for key_corr, parameters in updates_by_column.items():
+        cursor.executemany(
+            f"UPDATE {table_name} SET {key_corr} = ? WHERE rowid = ?",
+            parameters
+        )
+    cursor.executemany(
+        f"""
+        INSERT INTO {CORRECTION_LOG}
+        (batch_id, table_name, row_id, column_name,
+         old_value, new_value, source)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        log_entries
+    )
 
     conn.commit()
     conn.close()
+
+
+def undo_corrections(table_name: str) -> bool:
+    """
+    Reverts the last batch of corrections of a table by replaying
+    its logged deltas backwards.
+
+    Parameters
+    ----------
+    table_name: str
+        The name of the table
+
+    Returns
+    -------
+    bool
+        True if a batch was reverted, False if there was nothing to undo
+    """
+    return _replay_batch(table_name, undo=True)
+
+
+def redo_corrections(table_name: str) -> bool:
+    """
+    Applies the last reverted batch of corrections of a table again.
+
+    Parameters
+    ----------
+    table_name: str
+        The name of the table
+
+    Returns
+    -------
+    bool
+        True if a batch was applied, False if there was nothing to redo
+    """
+    return _replay_batch(table_name, undo=False)
+
+
+def _replay_batch(table_name: str, undo: bool) -> bool:
+    """
+    Replays the deltas of one batch of the correction log, touching
+    only the logged cells.
+
+    Parameters
+    ----------
+    table_name: str
+        The name of the table
+    undo: bool
+        Whether to revert the last applied batch or to reapply the
+        first reverted one
+
+    Returns
+    -------
+    bool
+        True if a batch was replayed
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    create_log_table(cursor)
+    aggregate = "MAX" if undo else "MIN"
+    cursor.execute(
+        f"""
+        SELECT {aggregate}(batch_id) FROM {CORRECTION_LOG}
+        WHERE table_name = ? AND undone = ?
+        """,
+        (table_name, 0 if undo else 1)
+    )
+    batch_id = cursor.fetchone()[0]
+    if batch_id is None:
+        conn.close()
+        return False
+
+    cursor.execute(
+        f"""
+        SELECT row_id, column_name, old_value, new_value
+        FROM {CORRECTION_LOG} WHERE batch_id = ?
+        ORDER BY id {"DESC" if undo else "ASC"}
+        """,
+        (batch_id,)
+    )
+    for row_id, column_name, old_value, new_value in cursor.fetchall():
+        cursor.execute(
+            f"UPDATE {table_name} SET {column_name} = ? WHERE rowid = ?",
+            (old_value if undo else new_value, row_id)
+        )
+    cursor.execute(
+        f"UPDATE {CORRECTION_LOG} SET undone = ? WHERE batch_id = ?",
+        (1 if undo else 0, batch_id)
+    )
+    conn.commit()
+    conn.close()
+    return True
+
+
+def export_changes(table_name: str) -> bytes:
+    """
+    Returns the applied corrections of a table as a CSV file.
+
+    Parameters
+    ----------
+    table_name: str
+        The name of the table
+
+    Returns
+    -------
+    bytes
+        The CSV file with one line per corrected cell
+    """
+    conn = get_connection()
+    create_log_table(conn.cursor())
+    df = pd.read_sql_query(
+        f"""
+        SELECT row_id, column_name, old_value, new_value, source, created_at
+        FROM {CORRECTION_LOG}
+        WHERE table_name = ? AND undone = 0
+        ORDER BY id
+        """,
+        conn,
+        params=(table_name,)
+    )
+    conn.close()
+    return df.to_csv(index=False).encode("utf-8")
+
+
+def export_table(table_name: str, path: str, chunksize: int = 10000) -> None:
+    """
+    Writes a table from the SQLite database to a CSV file in chunks,
+    so the table never has to fit into memory.
+
+    Parameters
+    ----------
+    table_name: str
+        The name of the table
+    path: str
+        The path of the CSV file
+    chunksize: int
+        The number of rows written at once
+
+    Returns
+    -------
+    None
+    """
+    conn = get_connection()
+    chunks = pd.read_sql_query(
+        f"SELECT * FROM {table_name}", conn, chunksize=chunksize
+    )
+    with open(path, "w", newline="") as csv_file:
+        for i, chunk in enumerate(chunks):
+            chunk.to_csv(csv_file, index=False, header=i == 0)
+    conn.close()
@@ -1,11 +1,48 @@
+import numpy as np
 import pandas as pd
 import os
 import re
 import json
+import math
+import time
 import asyncio
+import threading
+import importlib.util
 from dotenv import load_dotenv
 from typing import Union
-from openai import OpenAI, AsyncOpenAI
+import manifest as missing_manifest
+import profiler
+
+# Used when the prompt file contains no example output to measure
+DEFAULT_COMPLETION_TOKENS = 100
+
+
+def count_tokens(text: str, model_name: str = None) -> int:
+    """
+    Counts the tokens of a text with tiktoken if it is installed,
+    otherwise approximates them with four characters per token.
+
+    Parameters
+    ----------
+    text: str
+        The text to count
+    model_name: str
+        The name of the model, used to pick the encoding
+
+    Returns
+    -------
+    int
+        The number of tokens
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return math.ceil(len(text) / 4)
+    try:
+        encoding = tiktoken.encoding_for_model(model_name)
+    except (KeyError, TypeError):
+        encoding = tiktoken.get_encoding("o200k_base")
+    return len(encoding.encode(text))
 
 
 class LLMAgent:
@@ -22,6 +59,13 @@ class LLMAgent:
         The API key for the OpenAI API
     port : int
         The port of the OpenAI API
+    base_url : str
+        The base URL of an OpenAI compatible API, defaults to OpenAI
+    max_concurrency : int
+        The maximum number of requests in flight at the same time
+    stream : bool
+        Whether to stream the answers and stop reading as soon as
+        the suggested value is complete
 
     Methods
     -------
@@ -31,9 +75,21 @@ class LLMAgent:
         Sends prompt and returns response
     """
 
-    def __init__(self, model_name: str = None, temperature: float = None):
+    def __init__(
+        self,
+        model_name: str = None,
+        temperature: float = None,
+        base_url: str = None,
+        max_concurrency: int = None,
+        stream: bool = None,
+    ):
         load_dotenv()
         self.api_key = os.getenv("OPENAI_API_KEY")
+        self.base_url = (
+            base_url
+            if base_url is not None
+            else os.getenv("OPENAI_BASE_URL")
+        )
         if model_name is None:
             self.model_name = os.getenv("MODEL_NAME")
         else:
@@ -61,7 +117,106 @@ class LLMAgent:
         self.suggesting_prompt = self.read_prompt(
             os.getenv("SUGGESTION_PROMPT")
         )
-        self.client = AsyncOpenAI(api_key=self.api_key)
+        self.max_connections = int(os.getenv("MAX_CONNECTIONS", 100))
+        self.max_concurrency = (
+            max_concurrency
+            if max_concurrency is not None
+            else int(os.getenv("MAX_CONCURRENCY", self.max_connections))
+        )
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.stream = (
+            stream
+            if stream is not None
+            else os.getenv("STREAM", "false").lower() == "true"
+        )
+        self.usage = {
+            "requests": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "streamed_requests": 0,
+            "seconds_to_value": 0.0,
+            "completion_tokens_saved": 0,
+            "seconds_saved": 0.0,
+        }
+        self._completion_tokens = None
+        self._skipped_tokens = None
+        self._client = None
+        self._loop = None
+        self._loop_lock = threading.Lock()
+
+    @property
+    def client(self):
+        """
+        Lazily creates the AsyncOpenAI client on first use. The client
+        is backed by a single httpx connection pool (HTTP/2 if the
+        ``h2`` package is installed) that is kept alive for the
+        lifetime of the agent.
+
+        Returns
+        -------
+        AsyncOpenAI
+            The OpenAI client
+        """
+        if self._client is None:
+            import httpx
+            from openai import AsyncOpenAI
+
+            http_client = httpx.AsyncClient(
+                http2=importlib.util.find_spec("h2") is not None,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=60,
+                ),
+                timeout=httpx.Timeout(60, connect=10),
+            )
+            self._client = AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=self.base_url,
+                http_client=http_client,
+            )
+        return self._client
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        """
+        Returns the event loop owned by the agent, starting it in a
+        daemon thread if necessary. The pooled connections of the client
+        are bound to this loop, so all requests have to run on it.
+
+        Returns
+        -------
+        asyncio.AbstractEventLoop
+            The event loop of the agent
+        """
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever,
+                    name="llm-agent-loop",
+                    daemon=True,
+                ).start()
+        return self._loop
+
+    def run(self, coroutine):
+        """
+        Runs a coroutine on the event loop of the agent and blocks until
+        it is finished. Use this instead of ``asyncio.run`` so that the
+        connection pool is reused across calls.
+
+        Parameters
+        ----------
+        coroutine : Coroutine
+            The coroutine to run
+
+        Returns
+        -------
+        Any
+            The result of the coroutine
+        """
+        return asyncio.run_coroutine_threadsafe(
+            coroutine, self._get_loop()
+        ).result()
 
     def read_prompt(
         self, prompt_file_name: str
@@ -100,15 +255,85 @@ class LLMAgent:
         str
             The prepared user prompt
         """
-        columns_nan = [
-            col for col in df_row.columns if pd.isnull(df_row[col].values[0])
+        return self._format_user_prompt(
+            summary_stats_json=summary_stats_json,
+            corr_matrix_json=corr_matrix_json,
+            row_json=self._rows_to_json(df_row, [0])[0],
+            column_missing=column_missing,
+            column_dtype=df_row[column_missing].dtype,
+        )
+
+    def _rows_to_json(
+        self, df: pd.DataFrame, positions: list[int]
+    ) -> list[str]:
+        """
+        Serializes the values of several rows that are not missing in one
+        pass. Every value keeps the dtype of its column.
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            The DataFrame containing the rows
+        positions : list[int]
+            The positions of the rows with missing values
+
+        Returns
+        -------
+        list[str]
+            The rows without missing values in JSON format, in the order
+            of positions
+        """
+        df_rows = df.iloc[positions]
+        # Same precision as DataFrame.to_json, which the prompt used before
+        df_rows = df_rows[df_rows.columns.sort_values()].round(10)
+        columns = df_rows.columns.tolist()
+        not_missing = df_rows.notna().to_numpy()
+        return [
+            json.dumps(
+                {
+                    col: value
+                    for col, value, keep in zip(columns, row, row_mask)
+                    if keep
+                },
+                separators=(",", ":"),
+                default=str,
+            )
+            for row, row_mask in zip(
+                df_rows.itertuples(index=False, name=None), not_missing
+            )
         ]
-        temp_row_no_nan = df_row[df_row.columns.difference(columns_nan)]
-        temp_row_no_nan = temp_row_no_nan.iloc[0].to_json()
-        column_dtype = df_row[column_missing].dtype
 
+    def _format_user_prompt(
+        self,
+        summary_stats_json: str,
+        corr_matrix_json: str,
+        row_json: str,
+        column_missing: str,
+        column_dtype: np.dtype,
+    ) -> str:
+        """
+        Fills the user prompt template.
+
+        Parameters
+        ----------
+        summary_stats_json : str
+            The summary statistics in JSON format
+        corr_matrix_json : str
+            The correlation matrix in JSON format
+        row_json : str
+            The row without missing values in JSON format
+        column_missing : str
+            The column name of the missing value
+        column_dtype : numpy.dtype
+            The dtype of the column with the missing value
+
+        Returns
+        -------
+        str
+            The prepared user prompt
+        """
         user_prompt = f"""
-        <row>{temp_row_no_nan}</row>
+        <row>{row_json}</row>
         <column_name>>{column_missing}</<column_name>
         <column_dtype>>{column_dtype}</<column_dtype>
         <summary_statistics>{summary_stats_json}</summary_statistics>
@@ -119,8 +344,10 @@ class LLMAgent:
 
     async def send_prompt_async(
         self,
-        user_prompt: str
-    ) -> str:
+        user_prompt: str,
+        usage: dict = None,
+        token_budget: int = None
+    ) -> Union[str, None]:
         """
         Sends prompt and returns response asynchronously
 
@@ -128,27 +355,244 @@ class LLMAgent:
         ----------
         user_prompt : str
             The user prompt
+        usage : dict
+            The token usage of the current run, created by new_usage and
+            updated in place
+        token_budget : int
+            The maximum number of tokens the run may spend, checked
+            against usage right before the request is sent
 
         Returns
         -------
-        str
-            The response
+        str | None
+            The response, None if the request would exceed the budget
         """
         messages = [{"role": "developer", "content": self.suggesting_prompt}]
         messages.append({"role": "user", "content": user_prompt})
 
-        response = await self.client.chat.completions.create(
+        async with self._semaphore:
+            estimate = 0
+            if token_budget is not None:
+                # Requests in flight reserve their estimated tokens, so
+                # concurrent requests cannot overshoot the budget together
+                estimate = self._estimate_tokens(messages)
+                spent = (
+                    usage["prompt_tokens"]
+                    + usage["completion_tokens"]
+                    + usage["reserved_tokens"]
+                )
+                if spent + estimate > token_budget:
+                    usage["skipped"] += 1
+                    return None
+                usage["reserved_tokens"] += estimate
+            try:
+                if self.stream:
+                    return await self._stream_prompt_async(messages, usage)
+                response = await self.client.chat.completions.create(
+                    model=self.model_name,
+                    messages=messages,
+                    temperature=self.temperature
+                )
+            finally:
+                if usage is not None:
+                    usage["reserved_tokens"] -= estimate
+
+        if response.usage is not None:
+            self._record_usage(
+                usage,
+                response.usage.prompt_tokens,
+                response.usage.completion_tokens
+            )
+        else:
+            self._record_usage(usage, 0, 0)
+        return response.choices[0].message.content
+
+    def new_usage(self) -> dict:
+        """
+        Returns an empty token usage for one run, see send_prompt_async.
+
+        Returns
+        -------
+        dict
+            The usage of the run
+        """
+        return {
+            "requests": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "reserved_tokens": 0,
+            "skipped": 0,
+        }
+
+    def _record_usage(
+        self, usage: dict, prompt_tokens: int, completion_tokens: int
+    ) -> None:
+        """
+        Adds the tokens of one request to the totals of the agent and,
+        if given, to the usage of the current run.
+
+        Parameters
+        ----------
+        usage : dict
+            The usage of the current run or None
+        prompt_tokens : int
+            The prompt tokens of the request
+        completion_tokens : int
+            The completion tokens of the request
+
+        Returns
+        -------
+        None
+        """
+        for totals in (self.usage, usage):
+            if totals is None:
+                continue
+            totals["requests"] += 1
+            totals["prompt_tokens"] += prompt_tokens
+            totals["completion_tokens"] += completion_tokens
+
+    def _estimate_tokens(self, messages: list[dict]) -> int:
+        """
+        Estimates the prompt and completion tokens of one request.
+
+        Parameters
+        ----------
+        messages : list[dict]
+            The messages to send
+
+        Returns
+        -------
+        int
+            The estimated tokens
+        """
+        return sum(
+            count_tokens(message["content"], self.model_name)
+            for message in messages
+        ) + self.estimate_completion_tokens()
+
+    async def _stream_prompt_async(
+        self, messages: list[dict], usage: dict = None
+    ) -> str:
+        """
+        Streams the answer and closes the stream as soon as the suggested
+        value can be parsed, skipping the rest of the answer. As the usage
+        is only sent at the end of a stream, the tokens of terminated
+        streams are counted locally.
+
+        Parameters
+        ----------
+        messages : list[dict]
+            The messages to send
+        usage : dict
+            The token usage of the current run
+
+        Returns
+        -------
+        str
+            The answer received up to the suggested value
+        """
+        start = time.perf_counter()
+        stream = await self.client.chat.completions.create(
             model=self.model_name,
             messages=messages,
-            temperature=self.temperature
+            temperature=self.temperature,
+            stream=True,
+            stream_options={"include_usage": True}
         )
-        return response.choices[0].message.content
+        content = ""
+        chunks = 0
+        first_chunk = None
+        stream_usage = None
+        value_found = False
+        async for chunk in stream:
+            if chunk.usage is not None:
+                stream_usage = chunk.usage
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if first_chunk is None:
+                first_chunk = time.perf_counter()
+            content += chunk.choices[0].delta.content
+            chunks += 1
+            if self._find_value(content) is not None:
+                value_found = True
+                await stream.close()
+                break
+        seconds_to_value = time.perf_counter() - start
+
+        if stream_usage is not None:
+            self._record_usage(
+                usage,
+                stream_usage.prompt_tokens,
+                stream_usage.completion_tokens
+            )
+        else:
+            self._record_usage(
+                usage,
+                sum(
+                    count_tokens(message["content"], self.model_name)
+                    for message in messages
+                ),
+                chunks
+            )
+        if value_found:
+            tokens_saved = self.estimate_skipped_tokens()
+            seconds_per_token = (
+                (time.perf_counter() - first_chunk) / max(chunks - 1, 1)
+            )
+            self.usage["streamed_requests"] += 1
+            self.usage["seconds_to_value"] += seconds_to_value
+            self.usage["completion_tokens_saved"] += tokens_saved
+            self.usage["seconds_saved"] += tokens_saved * seconds_per_token
+        return content
+
+    def estimate_completion_tokens(self) -> int:
+        """
+        Estimates the tokens of one complete answer from the example
+        output of the suggestion prompt.
+
+        Returns
+        -------
+        int
+            The estimated completion tokens per request
+        """
+        if self._completion_tokens is None:
+            _, found, example = self.suggesting_prompt.partition("**Output**")
+            self._completion_tokens = (
+                count_tokens(example.strip(), self.model_name)
+                if found
+                else DEFAULT_COMPLETION_TOKENS
+            )
+        return self._completion_tokens
+
+    def estimate_skipped_tokens(self) -> int:
+        """
+        Estimates the tokens a streamed answer skips after the suggested
+        value from the example output of the suggestion prompt: the reason
+        for a prompt that asks for the value first, only the end of the
+        JSON otherwise.
+
+        Returns
+        -------
+        int
+            The estimated completion tokens skipped per request
+        """
+        if self._skipped_tokens is None:
+            _, _, example = self.suggesting_prompt.partition("**Output**")
+            found = self._locate_value(example.strip())
+            self._skipped_tokens = (
+                count_tokens(example.strip()[found[1]:], self.model_name)
+                if found is not None
+                else 0
+            )
+        return self._skipped_tokens
 
     async def get_response(
         self,
         user_prompt: str,
         index: int,
-        column_missing: str
+        column_missing: str,
+        usage: dict = None,
+        token_budget: int = None
     ):
         """
         Sends prompt and returns response asynchronously
@@ -161,47 +605,146 @@ class LLMAgent:
             The index of the row
         column_missing : str
             The column name of the missing value
+        usage : dict
+            The token usage of the current run
+        token_budget : int
+            The maximum number of tokens the run may spend
 
         Returns
         -------
         str
-            The response
+            The response, None if the request failed or was skipped
+            because of the budget
         """
-        response = await self.send_prompt_async(user_prompt)
+        from openai import APIError
+
+        try:
+            response = await self.send_prompt_async(
+                user_prompt, usage=usage, token_budget=token_budget
+            )
+        except APIError as error:
+            # A failed request must not cancel the other requests
+            print(
+                f"Request for row {index}, column {column_missing} "
+                f"failed: {error}"
+            )
+            response = None
         return {
             "index": index,
             "column_missing": column_missing,
             "response": response
         }
 
+    def summarize_table(
+        self,
+        df_original: pd.DataFrame,
+        profile: profiler.TableProfile = None
+    ) -> tuple[str, str]:
+        """
+        Returns the summary statistics and the correlation matrix of the
+        table, from the streamed profile if given.
+
+        Parameters
+        ----------
+        df_original : pd.DataFrame
+            The whole table
+        profile : profiler.TableProfile
+            The streamed profile of the table
+
+        Returns
+        -------
+        tuple[str, str]
+            The summary statistics and the correlation matrix in JSON format
+        """
+        if profile is not None:
+            return profile.summary_stats_json(), profile.corr_matrix_json()
+        return (
+            df_original.describe().to_json(),
+            df_original.select_dtypes(include='number').corr().to_json()
+        )
+
     async def send_missing_values_to_llm(
         self,
         df_original: pd.DataFrame,
-        df_error: pd.DataFrame
+        df_error: pd.DataFrame,
+        cells: list[tuple[int, str]] = None,
+        manifest: np.ndarray = None,
+        profile: profiler.TableProfile = None,
+        usage: dict = None,
+        token_budget: int = None
     ):
-        summary_stats_json = df_original.describe().to_json()
-        corr_matrix_json = (
-            df_original.select_dtypes(include='number').corr().to_json()
+        """
+        Sends one prompt per missing value of df_error to the LLM. With a
+        token budget, requests are no longer sent once the usage of the
+        run reaches it; their responses are None.
+
+        Parameters
+        ----------
+        df_original : pd.DataFrame
+            The whole table, used for the summary statistics, may be
+            None if profile is given
+        df_error : pd.DataFrame
+            The rows with missing values
+        cells : list[tuple[int, str]]
+            If given, only these (row position, column) pairs are sent
+        manifest : np.ndarray
+            The missing value manifest of df_error, built if not given
+        profile : profiler.TableProfile
+            The streamed profile of the table, used instead of df_original
+        usage : dict
+            The token usage of the run, created by new_usage and updated
+            in place; required if token_budget is given
+        token_budget : int
+            The maximum number of tokens the run may spend
+
+        Returns
+        -------
+        list[dict[str, str, str]]
+            The responses of the LLM
+        """
+        if token_budget is not None and usage is None:
+            usage = self.new_usage()
+        if cells is not None:
+            cells = set(cells)
+        if manifest is None:
+            manifest = missing_manifest.build_manifest(df_error)
+        summary_stats_json, corr_matrix_json = self.summarize_table(
+            df_original, profile
         )
-        tasks = []
-        async with asyncio.TaskGroup() as tg:
-            for index, _ in df_error.iterrows():
-                temp_row = df_error.iloc[[index]]
+        dtypes = df_error.dtypes
+        rows = []
+        for index, _, columns_nan in missing_manifest.iter_rows(
+            manifest, df_error.columns
+        ):
+            if cells is not None:
                 columns_nan = [
-                    col for col in temp_row.columns if
-                    pd.isnull(temp_row[col].values[0])
+                    col for col in columns_nan if (index, col) in cells
                 ]
+                if not columns_nan:
+                    continue
+            rows.append((index, columns_nan))
+        rows_json = self._rows_to_json(
+            df_error, [index for index, _ in rows]
+        )
 
+        tasks = []
+        async with asyncio.TaskGroup() as tg:
+            for (index, columns_nan), row_json in zip(rows, rows_json):
                 for column_missing in columns_nan:
-                    prepared_prompt = self.prepare_prompt(
+                    prepared_prompt = self._format_user_prompt(
                         summary_stats_json=summary_stats_json,
                         corr_matrix_json=corr_matrix_json,
-                        df_row=temp_row,
-                        column_missing=column_missing
+                        row_json=row_json,
+                        column_missing=column_missing,
+                        column_dtype=dtypes[column_missing]
                     )
                     task = tg.create_task(
                         self.get_response(
-                            prepared_prompt, index, column_missing
+                            prepared_prompt,
+                            index,
+                            column_missing,
+                            usage=usage,
+                            token_budget=token_budget
                         )
                     )
                     tasks.append(task)
@@ -225,10 +768,14 @@ class LLMAgent:
         dict
             The extracted JSON.
         """
+        match = re.search(r"```json\s([\s\S]*?)```", response)
+        if match is None:
+            # Streamed answers are cut off right after the value
+            value = self._find_value(response)
+            if value is not None:
+                return value
         try:
-            return json.loads(
-                re.search(r"```json\s([\s\S]*?)```", response).group(1)
-            )
+            return json.loads(match.group(1))
         except AttributeError:
             print(f"""
             Json could not be found for response:
@@ -236,9 +783,62 @@ class LLMAgent:
             """)
             raise AttributeError
 
+    def _find_value(self, response: str) -> Union[dict, None]:
+        """
+        Parses the suggested value from a possibly incomplete answer.
+        The value must open the JSON object, after the ```json fence or at
+        the start of the answer, and counts as complete once it is followed
+        by a comma, a closing brace or whitespace, so numbers are not cut
+        off in the middle.
+
+        Parameters
+        ----------
+        response : str
+            The answer received so far
+
+        Returns
+        -------
+        dict | None
+            The JSON with the value or None if it is not complete yet
+        """
+        found = self._locate_value(response)
+        if found is None:
+            return None
+        return {"value": found[0]}
+
+    def _locate_value(self, response: str) -> Union[tuple, None]:
+        """
+        Parses the suggested value like _find_value and also returns
+        where it ends.
+
+        Parameters
+        ----------
+        response : str
+            The answer received so far
+
+        Returns
+        -------
+        tuple | None
+            The value and the position after it or None if it is not
+            complete yet
+        """
+        match = re.search(r'```json\s*\{\s*"value"\s*:\s*', response)
+        if match is None:
+            match = re.match(r'\s*\{\s*"value"\s*:\s*', response)
+        if match is None:
+            return None
+        try:
+            value, end = json.JSONDecoder().raw_decode(response, match.end())
+        except json.JSONDecodeError:
+            return None
+        if end >= len(response) or response[end] not in ",} \t\r\n":
+            return None
+        return value, end
+
     def gather_respones(
         self,
-        response_list: list[dict[str, str, str]]
+        response_list: list[dict[str, str, str]],
+        failures: list[tuple[int, str]] = None
     ) -> dict[str, dict[str, str]]:
         """
         Gathers the responses into a dictionary
@@ -247,6 +847,10 @@ class LLMAgent:
         ----------
         response_list : list[dict[str, str, str]]
             The list of responses
+        failures : list[tuple[int, str]]
+            If given, the (index, column) pairs of failed requests and of
+            responses without a value are appended to it and skipped,
+            otherwise such a response raises an error
 
         Returns
         -------
@@ -257,9 +861,17 @@ class LLMAgent:
         for item in response_list:
             index = item["index"]
             column_missing = item["column_missing"]
-            response = self._extract_json_from_response(
-                item["response"]
-            )["value"]
+            try:
+                if item["response"] is None:
+                    raise ValueError("The request failed")
+                response = self._extract_json_from_response(
+                    item["response"]
+                )["value"]
+            except (AttributeError, KeyError, TypeError, ValueError):
+                if failures is None:
+                    raise
+                failures.append((index, column_missing))
+                continue
             if index not in responses_dict:
                 responses_dict[index] = {}
             responses_dict[index][column_missing] = response
@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+from typing import Iterator
+
+MANIFEST_DTYPE = np.dtype([
+    ("position", np.int64),
+    ("rowid", np.int64),
+    ("column", np.int32),
+])
+
+
+def build_manifest(df: pd.DataFrame) -> np.ndarray:
+    """
+    Lists all missing values of a DataFrame in one vectorized pass.
+    The entries are ordered by row and then by column.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        The DataFrame to search, its index holds the rowids if it
+        is an integer index
+
+    Returns
+    -------
+    np.ndarray
+        A structured array with the row position, the rowid and the
+        column code (position in df.columns) of every missing value
+    """
+    rows, cols = np.nonzero(df.isna().to_numpy())
+    manifest = np.empty(len(rows), dtype=MANIFEST_DTYPE)
+    manifest["position"] = rows
+    if pd.api.types.is_integer_dtype(df.index):
+        manifest["rowid"] = df.index.to_numpy()[rows]
+    else:
+        manifest["rowid"] = rows
+    manifest["column"] = cols
+    return manifest
+
+
+def slice_manifest(manifest: np.ndarray, start: int, end: int) -> np.ndarray:
+    """
+    Returns the entries of the rows start to end, with the positions
+    relative to start, matching df.iloc[start:end].
+
+    Parameters
+    ----------
+    manifest: np.ndarray
+        The manifest returned by build_manifest
+    start: int
+        The first row position
+    end: int
+        The row position after the last row
+
+    Returns
+    -------
+    np.ndarray
+        The manifest of the slice
+    """
+    lower, upper = np.searchsorted(manifest["position"], [start, end])
+    sliced = manifest[lower:upper].copy()
+    sliced["position"] -= start
+    return sliced
+
+
+def iter_cells(
+    manifest: np.ndarray, columns: pd.Index
+) -> Iterator[tuple[int, int, str]]:
+    """
+    Iterates over the missing values of a manifest.
+
+    Parameters
+    ----------
+    manifest: np.ndarray
+        The manifest returned by build_manifest
+    columns: pd.Index
+        The columns of the DataFrame the manifest was built from
+
+    Yields
+    ------
+    tuple[int, int, str]
+        The row position, the rowid and the column name
+    """
+    names = np.asarray(columns, dtype=object)[manifest["column"]].tolist()
+    for (position, rowid, _), name in zip(manifest.tolist(), names):
+        yield position, rowid, name
+
+
+def iter_rows(
+    manifest: np.ndarray, columns: pd.Index
+) -> Iterator[tuple[int, int, list[str]]]:
+    """
+    Iterates over the rows of a manifest.
+
+    Parameters
+    ----------
+    manifest: np.ndarray
+        The manifest returned by build_manifest
+    columns: pd.Index
+        The columns of the DataFrame the manifest was built from
+
+    Yields
+    ------
+    tuple[int, int, list[str]]
+        The row position, the rowid and the names of the columns
+        with missing values
+    """
+    if len(manifest) == 0:
+        return
+    positions = manifest["position"]
+    starts = np.flatnonzero(
+        np.concatenate(([True], positions[1:] != positions[:-1]))
+    )
+    ends = np.append(starts[1:], len(manifest))
+    names = np.asarray(columns, dtype=object)[manifest["column"]].tolist()
+    rows = zip(
+        positions[starts].tolist(),
+        manifest["rowid"][starts].tolist(),
+        starts.tolist(),
+        ends.tolist(),
+    )
+    for position, rowid, start, end in rows:
+        yield position, rowid, names[start:end]
@@ -0,0 +1,162 @@
+import math
+import random
+import numpy as np
+import pandas as pd
+import llm
+import manifest as missing_manifest
+import profiler
+
+# Per message overhead of the chat format
+MESSAGE_OVERHEAD_TOKENS = 4
+SAMPLE_SIZE = 50
+
+
+def plan_imputation(
+    agent: llm.LLMAgent,
+    df_original: pd.DataFrame,
+    df_error: pd.DataFrame,
+    token_budget: int = None,
+    seconds_per_request: float = 2.0,
+    seed: int = 0,
+    manifest: np.ndarray = None,
+    profile: profiler.TableProfile = None,
+) -> dict:
+    """
+    Estimates the requests, tokens and duration needed to impute all
+    missing values of a table before anything is sent. If the estimate
+    exceeds the token budget, a random sample of the missing values that
+    fits the budget is sent to the LLM and the rest is imputed locally.
+
+    Parameters
+    ----------
+    agent: llm.LLMAgent
+        The agent that will send the prompts
+    df_original: pd.DataFrame
+        The whole table, used for the summary statistics, may be None
+        if profile is given
+    df_error: pd.DataFrame
+        The rows with missing values
+    token_budget: int
+        The maximum number of prompt and completion tokens to spend,
+        no limit if None
+    seconds_per_request: float
+        The expected latency of one request
+    seed: int
+        The seed for sampling the missing values sent to the LLM
+    manifest: np.ndarray
+        The missing value manifest of df_error, built if not given
+    profile: profiler.TableProfile
+        The streamed profile of the table, used instead of df_original
+
+    Returns
+    -------
+    dict
+        The plan with the cells to send to the LLM (llm_cells), the cells
+        to impute locally (local_cells) and the estimates for llm_cells
+    """
+    if manifest is None:
+        manifest = missing_manifest.build_manifest(df_error)
+    cells = [
+        (index, col) for index, _, col in missing_manifest.iter_cells(
+            manifest, df_error.columns
+        )
+    ]
+    summary_stats_json, corr_matrix_json = agent.summarize_table(
+        df_original, profile
+    )
+    system_tokens = (
+        llm.count_tokens(agent.suggesting_prompt, agent.model_name)
+        + 2 * MESSAGE_OVERHEAD_TOKENS
+    )
+    sample = random.Random(seed).sample(cells, min(len(cells), SAMPLE_SIZE))
+    user_tokens = [
+        llm.count_tokens(
+            agent.prepare_prompt(
+                summary_stats_json=summary_stats_json,
+                corr_matrix_json=corr_matrix_json,
+                df_row=df_error.iloc[[index]],
+                column_missing=col,
+            ),
+            agent.model_name,
+        )
+        for index, col in sample
+    ]
+    prompt_tokens_per_cell = system_tokens + (
+        sum(user_tokens) / len(user_tokens) if user_tokens else 0
+    )
+    completion_tokens_per_cell = agent.estimate_completion_tokens()
+    tokens_per_cell = prompt_tokens_per_cell + completion_tokens_per_cell
+
+    llm_cells = cells
+    local_cells = []
+    if token_budget is not None and tokens_per_cell * len(cells) > token_budget:
+        n_llm = max(0, int(token_budget // tokens_per_cell))
+        llm_cells = sorted(random.Random(seed).sample(cells, n_llm))
+        selected = set(llm_cells)
+        local_cells = [cell for cell in cells if cell not in selected]
+
+    return {
+        "missing_cells": len(cells),
+        "llm_cells": llm_cells,
+        "local_cells": local_cells,
+        "requests": len(llm_cells),
+        "prompt_tokens": round(prompt_tokens_per_cell * len(llm_cells)),
+        "completion_tokens": round(
+            completion_tokens_per_cell * len(llm_cells)
+        ),
+        "seconds": (
+            math.ceil(len(llm_cells) / agent.max_concurrency)
+            * seconds_per_request
+        ),
+    }
+
+
+def impute_locally(
+    df_original: pd.DataFrame,
+    cells: list[tuple[int, str]],
+    profile: profiler.TableProfile = None,
+) -> dict[int, dict[str, object]]:
+    """
+    Imputes missing values without the LLM: the median for numeric
+    columns and the most frequent value for all other columns.
+
+    Parameters
+    ----------
+    df_original: pd.DataFrame
+        The whole table, may be None if profile is given
+    cells: list[tuple[int, str]]
+        The (row position, column) pairs to impute
+    profile: profiler.TableProfile
+        The streamed profile of the table, used instead of df_original
+
+    Returns
+    -------
+    dict[int, dict[str, object]]
+        The imputed values in the format of LLMAgent.gather_respones
+    """
+    fill_values = {}
+    for col in {col for _, col in cells}:
+        if profile is not None:
+            value = profile.fill_value(col)
+            if value is not None:
+                fill_values[col] = value
+            continue
+        series = df_original[col].dropna()
+        if series.empty:
+            continue
+        if pd.api.types.is_integer_dtype(series):
+            fill_values[col] = int(round(series.median()))
+        elif pd.api.types.is_float_dtype(series):
+            value = series.median()
+            if (series % 1 == 0).all():
+                fill_values[col] = int(round(value))
+            else:
+                fill_values[col] = float(value)
+        else:
+            fill_values[col] = series.mode().iloc[0]
+
+    imputed = {}
+    for index, col in cells:
+        if col in fill_values:
+            imputed.setdefault(index, {})[col] = fill_values[col]
+    return imputed
@@ -0,0 +1,511 @@
+import math
+import warnings
+import numpy as np
+import pandas as pd
+
+PERCENTILES = [0.25, 0.5, 0.75]
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch (KLL). Items are kept in levels where an
+    item on level h stands for 2**h values; a full level is sorted and
+    every second item is promoted to the next level. The rank error of
+    a quantile is about 1.7 / k, as long as no compaction happened the
+    quantiles are exact.
+
+    Parameters
+    ----------
+    k : int
+        The capacity of the top level, controls accuracy and memory
+    seed : int
+        The seed for choosing which half of a level is promoted
+
+    Methods
+    -------
+    update(values)
+        Adds values to the sketch
+    merge(other)
+        Adds all values of another sketch
+    quantile(q)
+        Returns the approximate q-quantile
+    """
+
+    def __init__(self, k: int = 200, seed: int = 0):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.rng = np.random.default_rng(seed)
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self.levels) - 1 - level
+        return max(2, math.ceil(self.k * (2 / 3) ** depth))
+
+    def _compress(self) -> None:
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(self.levels[level])
+                # Keep one item back if the number of items is odd
+                keep = items[-1:] if len(items) % 2 else items[:0]
+                items = items[:len(items) - len(keep)]
+                offset = self.rng.integers(2)
+                self.levels[level + 1] = np.concatenate(
+                    (self.levels[level + 1], items[offset::2])
+                )
+                self.levels[level] = keep
+            level += 1
+
+    def update(self, values: np.ndarray) -> None:
+        self.levels[0] = np.concatenate(
+            (self.levels[0], np.asarray(values, dtype=float))
+        )
+        self._compress()
+
+    def merge(self, other: "QuantileSketch") -> None:
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate((self.levels[level], items))
+        self._compress()
+
+    def quantile(self, q: float) -> float:
+        if len(self.levels) == 1:
+            if len(self.levels[0]) == 0:
+                return np.nan
+            return float(np.quantile(self.levels[0], q))
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([
+            np.full(len(level_items), 2 ** level)
+            for level, level_items in enumerate(self.levels)
+        ])
+        order = np.argsort(items)
+        cumulative = np.cumsum(weights[order])
+        rank = np.searchsorted(cumulative, q * cumulative[-1])
+        return float(items[order][min(rank, len(items) - 1)])
+
+
+class FrequencySketch:
+    """
+    Mergeable sketch of the most frequent values (Misra-Gries) and of
+    the number of distinct values (k minimum values). Frequencies are
+    underestimated by at most count / (capacity + 1), the relative
+    error of the distinct count is about 1 / sqrt(distinct_k).
+
+    Parameters
+    ----------
+    capacity : int
+        The number of counters for frequent values
+    distinct_k : int
+        The number of hashes kept for the distinct count
+
+    Methods
+    -------
+    update(series)
+        Adds the values of a Series to the sketch
+    merge(other)
+        Adds all values of another sketch
+    top()
+        Returns the most frequent value and its frequency
+    unique()
+        Returns the approximate number of distinct values
+    """
+
+    def __init__(self, capacity: int = 100, distinct_k: int = 1024):
+        self.capacity = capacity
+        self.distinct_k = distinct_k
+        self.count = 0
+        self.counts = {}
+        self.hashes = np.empty(0, dtype=np.uint64)
+
+    def _merge_counts(self, counts: dict) -> None:
+        for value, count in counts.items():
+            self.counts[value] = self.counts.get(value, 0) + count
+        if len(self.counts) > self.capacity:
+            cutoff = sorted(self.counts.values(), reverse=True)[self.capacity]
+            self.counts = {
+                value: count - cutoff
+                for value, count in self.counts.items()
+                if count > cutoff
+            }
+
+    def _merge_hashes(self, hashes: np.ndarray) -> None:
+        self.hashes = np.unique(
+            np.concatenate((self.hashes, hashes))
+        )[:self.distinct_k]
+
+    def update(self, series: pd.Series) -> None:
+        series = series.dropna()
+        self.count += len(series)
+        self._merge_counts(series.value_counts().to_dict())
+        # pandas hashes are stable across processes, unlike hash()
+        self._merge_hashes(
+            pd.util.hash_pandas_object(series, index=False).to_numpy()
+        )
+
+    def merge(self, other: "FrequencySketch") -> None:
+        self.count += other.count
+        self._merge_counts(other.counts)
+        self._merge_hashes(other.hashes)
+
+    def top(self) -> tuple[object, int]:
+        if not self.counts:
+            return None, np.nan
+        value = max(self.counts, key=self.counts.get)
+        return value, self.counts[value]
+
+    def unique(self) -> int:
+        if len(self.hashes) < self.distinct_k:
+            return len(self.hashes)
+        largest = float(self.hashes[-1]) / 2 ** 64
+        return round((self.distinct_k - 1) / largest)
+
+
+class TableProfile:
+    """
+    One-pass profile of a table that is fed chunk by chunk and produces
+    the same JSON as describe() and select_dtypes("number").corr() on the
+    whole table. Counts, means, standard deviations, minima, maxima and
+    correlations are exact up to floating point rounding, percentiles and
+    the statistics of text columns are approximated by sketches. Memory
+    only depends on the number of columns, profiles of different chunks or
+    processes (after pickling) can be merged.
+
+    Parameters
+    ----------
+    k : int
+        The accuracy parameter of the quantile sketches
+
+    Methods
+    -------
+    update(df)
+        Adds a chunk of the table
+    merge(other)
+        Adds all rows of another profile
+    fill_value(col)
+        Returns the approximate median or most frequent value of a column
+    summary_stats_json()
+        Returns the summary statistics like describe().to_json()
+    corr_matrix_json()
+        Returns the correlation matrix like corr().to_json()
+    """
+
+    def __init__(self, k: int = 200):
+        self.k = k
+        self.rows = 0
+        self.columns = None
+        self.numeric_columns = None
+        self.text_columns = None
+        # Columns without any value so far, their type is not known yet
+        self.pending_columns = None
+        self.minimum = None
+        self.maximum = None
+        self.integral = None
+        # Pairwise statistics over the rows where both columns are set:
+        # count, mean of the row column, sum of squared deviations of the
+        # row column and co-moment
+        self.count = None
+        self.mean = None
+        self.m2 = None
+        self.comoment = None
+        self.quantiles = {}
+        self.frequencies = {}
+
+    def _init_columns(self, columns: list[str]) -> None:
+        self.columns = list(columns)
+        self.numeric_columns = []
+        self.text_columns = []
+        self.pending_columns = list(columns)
+        (
+            self.minimum, self.maximum, self.integral,
+            self.count, self.mean, self.m2, self.comoment
+        ) = self._aligned([])
+
+    def _aligned(self, columns: list[str]) -> tuple:
+        """
+        Returns the per column and pairwise statistics laid out for the
+        given numeric columns. Columns this profile has no statistics for
+        are empty, columns not in the layout are left out.
+        """
+        p = len(columns)
+        source, target = [], []
+        for i, col in enumerate(self.numeric_columns or []):
+            if col in columns:
+                source.append(i)
+                target.append(columns.index(col))
+        source = np.array(source, dtype=int)
+        target = np.array(target, dtype=int)
+        minimum = np.full(p, np.inf)
+        maximum = np.full(p, -np.inf)
+        integral = np.ones(p, dtype=bool)
+        if len(source):
+            minimum[target] = self.minimum[source]
+            maximum[target] = self.maximum[source]
+            integral[target] = self.integral[source]
+        pairwise = []
+        for matrix in (self.count, self.mean, self.m2, self.comoment):
+            full = np.zeros((p, p))
+            if len(source):
+                full[np.ix_(target, target)] = matrix[np.ix_(source, source)]
+            pairwise.append(full)
+        return (minimum, maximum, integral, *pairwise)
+
+    def _decide_columns(
+        self, numeric_columns: list[str], text_columns: list[str]
+    ) -> None:
+        """
+        Fixes the type of pending columns. As they had no values so far,
+        their statistics start empty.
+        """
+        if not numeric_columns and not text_columns:
+            return
+        decided = set(numeric_columns) | set(text_columns)
+        self.pending_columns = [
+            col for col in self.pending_columns if col not in decided
+        ]
+        for col in text_columns:
+            self.frequencies[col] = FrequencySketch()
+        self.text_columns = [
+            col for col in self.columns if col in self.frequencies
+        ]
+        if not numeric_columns:
+            return
+        for col in numeric_columns:
+            self.quantiles[col] = QuantileSketch(k=self.k)
+        columns = [col for col in self.columns if col in self.quantiles]
+        (
+            self.minimum, self.maximum, self.integral,
+            self.count, self.mean, self.m2, self.comoment
+        ) = self._aligned(columns)
+        self.numeric_columns = columns
+
+    def _merge_moments(self, count, mean, m2, comoment) -> None:
+        """
+        Merges pairwise moments with the parallel algorithm of Chan et al.
+        """
+        total = self.count + count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = np.where(total > 0, mean - self.mean, 0)
+            factor = np.where(total > 0, self.count * count / total, 0)
+            self.mean = np.where(
+                total > 0, self.mean + delta * count / total, 0
+            )
+        self.m2 = self.m2 + m2 + delta ** 2 * factor
+        self.comoment = self.comoment + comoment + delta * delta.T * factor
+        self.count = total
+
+    def update(self, df: pd.DataFrame) -> None:
+        """
+        Adds a chunk of the table. The type of a column is taken from the
+        first chunk in which it has values, later chunks are converted to
+        it.
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            The chunk
+
+        Returns
+        -------
+        None
+        """
+        if self.columns is None:
+            self._init_columns(df.columns)
+        if self.pending_columns:
+            # A column without values is read as float, so its type is
+            # only decided once a chunk has values for it
+            present = [
+                col for col in self.pending_columns if df[col].notna().any()
+            ]
+            numeric_columns = [
+                col for col in present
+                if pd.api.types.is_numeric_dtype(df[col])
+                and not pd.api.types.is_bool_dtype(df[col])
+            ]
+            self._decide_columns(
+                numeric_columns,
+                [col for col in present if col not in numeric_columns]
+            )
+        self.rows += len(df)
+        if len(df) == 0:
+            return
+
+        values = (
+            df[self.numeric_columns]
+            .apply(pd.to_numeric, errors="coerce")
+            .to_numpy(dtype=float)
+        )
+        mask = ~np.isnan(values)
+        weights = mask.astype(float)
+        # All-NaN columns only warn and are masked out below
+        with warnings.catch_warnings(), np.errstate(
+            invalid="ignore", divide="ignore"
+        ):
+            warnings.simplefilter("ignore", RuntimeWarning)
+            shift = np.nan_to_num(np.nanmean(values, axis=0))
+            centered = np.where(mask, values - shift, 0)
+            count = weights.T @ weights
+            sums = centered.T @ weights
+            mean = np.where(count > 0, shift[:, None] + sums / count, 0)
+            m2 = np.where(
+                count > 0, (centered ** 2).T @ weights - sums ** 2 / count, 0
+            )
+            comoment = np.where(
+                count > 0, centered.T @ centered - sums * sums.T / count, 0
+            )
+            self.minimum = np.fmin(self.minimum, np.nanmin(values, axis=0))
+            self.maximum = np.fmax(self.maximum, np.nanmax(values, axis=0))
+            self.integral &= np.all(
+                np.where(mask, values % 1 == 0, True), axis=0
+            )
+        self._merge_moments(count, mean, m2, comoment)
+
+        for i, col in enumerate(self.numeric_columns):
+            self.quantiles[col].update(values[mask[:, i], i])
+        for col in self.text_columns:
+            self.frequencies[col].update(df[col])
+
+    def merge(self, other: "TableProfile") -> None:
+        """
+        Adds all rows of another profile of the same table.
+
+        Parameters
+        ----------
+        other : TableProfile
+            The profile of other chunks
+
+        Returns
+        -------
+        None
+        """
+        if other.columns is None:
+            return
+        if self.columns is None:
+            self._init_columns(other.columns)
+        self._decide_columns(
+            [col for col in other.numeric_columns
+             if col in self.pending_columns],
+            [col for col in other.text_columns
+             if col in self.pending_columns],
+        )
+        self.rows += other.rows
+        # Columns typed differently in the two profiles keep the type of
+        # this profile, the values of the other profile are left out
+        (
+            minimum, maximum, integral, count, mean, m2, comoment
+        ) = other._aligned(self.numeric_columns)
+        self.minimum = np.fmin(self.minimum, minimum)
+        self.maximum = np.fmax(self.maximum, maximum)
+        self.integral &= integral
+        self._merge_moments(count, mean, m2, comoment)
+        for col in other.numeric_columns:
+            if col in self.quantiles:
+                self.quantiles[col].merge(other.quantiles[col])
+        for col in other.text_columns:
+            if col in self.frequencies:
+                self.frequencies[col].merge(other.frequencies[col])
+
+    def fill_value(self, col: str) -> object:
+        """
+        Returns the value used to impute a column without the LLM: the
+        approximate median of numeric columns, rounded if the column only
+        holds whole numbers, and the most frequent value of text columns.
+
+        Parameters
+        ----------
+        col : str
+            The name of the column
+
+        Returns
+        -------
+        object
+            The value or None if the column has no values
+        """
+        if col in self.quantiles:
+            median = self.quantiles[col].quantile(0.5)
+            if np.isnan(median):
+                return None
+            if self.integral[self.numeric_columns.index(col)]:
+                return int(round(median))
+            return median
+        if col in self.frequencies:
+            return self.frequencies[col].top()[0]
+        return None
+
+    def summary_stats(self) -> pd.DataFrame:
+        """
+        Returns the summary statistics in the layout of describe(): the
+        numeric columns if there are any, otherwise the text columns.
+        Columns without any value are numeric, like pandas reads them.
+
+        Returns
+        -------
+        pd.DataFrame
+            The summary statistics
+        """
+        columns = self._describe_columns()
+        if columns:
+            minimum, maximum, _, count, mean, m2, _ = self._aligned(columns)
+            count = np.diag(count)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                std = np.sqrt(np.diag(m2) / (count - 1))
+            stats = {
+                "count": count,
+                "mean": np.where(count > 0, np.diag(mean), np.nan),
+                "std": np.where(count > 1, std, np.nan),
+                "min": np.where(count > 0, minimum, np.nan),
+            }
+            for q in PERCENTILES:
+                stats[f"{q:.0%}"] = [
+                    self.quantiles[col].quantile(q)
+                    if col in self.quantiles
+                    else np.nan
+                    for col in columns
+                ]
+            stats["max"] = np.where(count > 0, maximum, np.nan)
+            return pd.DataFrame(stats, index=columns).T
+
+        stats = {}
+        for col in self.text_columns:
+            sketch = self.frequencies[col]
+            top, freq = sketch.top()
+            stats[col] = {
+                "count": sketch.count,
+                "unique": sketch.unique(),
+                "top": top,
+                "freq": freq,
+            }
+        return pd.DataFrame(stats)
+
+    def summary_stats_json(self) -> str:
+        return self.summary_stats().to_json()
+
+    def corr_matrix(self) -> pd.DataFrame:
+        """
+        Returns the pairwise correlation matrix of the numeric columns
+        like select_dtypes("number").corr().
+
+        Returns
+        -------
+        pd.DataFrame
+            The correlation matrix
+        """
+        columns = self._describe_columns()
+        _, _, _, count, _, m2, comoment = self._aligned(columns)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            corr = comoment / np.sqrt(m2 * m2.T)
+        corr = np.where(count > 1, corr, np.nan)
+        return pd.DataFrame(corr, index=columns, columns=columns)
+
+    def _describe_columns(self) -> list[str]:
+        """
+        Returns the numeric and the pending columns in table order.
+        """
+        return [
+            col for col in self.columns
+            if col in self.quantiles or col in self.pending_columns
+        ]
+
+    def corr_matrix_json(self) -> str:
+        return self.corr_matrix().to_json()
@@ -65,7 +65,10 @@ def get_all_tables() -> list:
     """
     conn = data_processing.get_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+    cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name != ?;",
+        (data_processing.CORRECTION_LOG,)
+    )
     tables = [table[0] for table in cursor.fetchall()]
     conn.close()
     return tables
@@ -189,65 +192,71 @@ def return_proper_selection(
         return st.text_input(label="Your own Input:", key=key)
 
 
-def display_error(df: pd.DataFrame, index: int, llm_suggestions: dict):
+def display_error(
+    df: pd.DataFrame,
+    index: int,
+    llm_suggestions: dict,
+    columns_nan: list[str] = None,
+):
     """
     Display and handle errors in DataFrame rows with state persistence.
-    Returns a dictionary of corrections for the current row.
+    Returns a dictionary of corrections for the current row. The columns
+    with missing values are looked up if columns_nan is not given.
     """
     row_key = f"row_{index}_state"
     if row_key not in st.session_state:
         st.session_state[row_key] = {"decisions": {}, "custom_values": {}}
 
     updated_values = {index: {}}
-    df_temp = df.iloc[[index]]
+    if columns_nan is None:
+        columns_nan = df.columns[df.iloc[index].isna().to_numpy()]
     st.write(f"### Row {index + 1} contains an error:")
 
-    for col in df_temp.columns:
-        if pd.isnull(df_temp[col].values[0]):
-            col_key = f"{index}_{col}"
+    for col in columns_nan:
+        col_key = f"{index}_{col}"
 
-            if col not in st.session_state[row_key]["decisions"]:
-                st.session_state[row_key]["decisions"][col] = "Yes"
-                st.session_state[row_key]["custom_values"][col] = None
+        if col not in st.session_state[row_key]["decisions"]:
+            st.session_state[row_key]["decisions"][col] = "Yes"
+            st.session_state[row_key]["custom_values"][col] = None
 
-            suggestion = llm_suggestions[index][col]
-            st.write(f"❗ Column '{col}' contains a NULL value.")
-
-            def on_radio_change():
-                st.session_state[row_key]["decisions"][col] = (
-                    st.session_state[f"{col_key}_radio"]
-                )
+        suggestion = llm_suggestions.get(index, {}).get(col)
+        st.write(f"❗ Column '{col}' contains a NULL value.")
 
-            agree = st.radio(
-                f"We suggest the value {suggestion}. Do you accept this suggestion?",
-                options=["Yes", "No, I want to pick my own value"],
-                key=f"{col_key}_radio",
-                horizontal=True,
-                on_change=on_radio_change,
-                index=0 if st.session_state[row_key]["decisions"][col] == "Yes" else 1,
+        def on_radio_change():
+            st.session_state[row_key]["decisions"][col] = (
+                st.session_state[f"{col_key}_radio"]
             )
 
-            if agree == "Yes":
-                updated_values[index][col] = suggestion
-            else:
-                if f"{col_key}_input" not in st.session_state:
-                    st.session_state[f"{col_key}_input"] = (
-                        st.session_state[row_key]["custom_values"][col]
-                    )
+        agree = st.radio(
+            f"We suggest the value {suggestion}. Do you accept this suggestion?",
+            options=["Yes", "No, I want to pick my own value"],
+            key=f"{col_key}_radio",
+            horizontal=True,
+            on_change=on_radio_change,
+            index=0 if st.session_state[row_key]["decisions"][col] == "Yes" else 1,
+        )
 
-                custom_value = return_proper_selection(
-                    df_temp[col].dtype, col_key
+        if agree == "Yes":
+            updated_values[index][col] = suggestion
+        else:
+            if f"{col_key}_input" not in st.session_state:
+                st.session_state[f"{col_key}_input"] = (
+                    st.session_state[row_key]["custom_values"][col]
                 )
 
-                if custom_value:
-                    st.session_state[row_key]["custom_values"][col] = (
-                        custom_value
-                    )
-                    updated_values[index][col] = custom_value
-                elif st.session_state[row_key]["custom_values"][col] is not None:
-                    updated_values[index][col] = st.session_state[row_key][
-                        "custom_values"
-                    ][col]
+            custom_value = return_proper_selection(
+                df[col].dtype, col_key
+            )
+
+            if custom_value:
+                st.session_state[row_key]["custom_values"][col] = (
+                    custom_value
+                )
+                updated_values[index][col] = custom_value
+            elif st.session_state[row_key]["custom_values"][col] is not None:
+                updated_values[index][col] = st.session_state[row_key][
+                    "custom_values"
+                ][col]
 
     return updated_values
 